@@ -1,7 +1,6 @@
 import streamlit as st
 import pandas as pd
-import io
-import time
+import numpy as np
 
 # --- Configuration ---
 st.set_page_config(page_title="H & M Expenses", page_icon="💰", layout="wide")
@@ -12,43 +11,195 @@ CATEGORIES = [
     "Laundry", "Shopping", "Miscellaneous", "Vacation / Entertainment"
 ]
 
+# Display position of each category, used to keep the CSV rows in list order
+CATEGORY_ORDER = {cat: i for i, cat in enumerate(CATEGORIES)}
+
+# Payer and Consumer are stored as integer codes: the index of the label in these
+# lists (-1 for a blank cell). Labels only appear when the UI renders them.
+PAYERS = ["H", "M"]
+CONSUMERS = ["Split", "H only", "M only"]
+PAYER_H = 0
+CONSUMER_SPLIT, CONSUMER_H_ONLY, CONSUMER_M_ONLY = 0, 1, 2
+
+COLUMNS = ["Category", "Amount", "Payer", "Consumer"]
+
+# Which per-category bucket each consumer code feeds; anything else is split
+CONSUMER_BUCKETS = {CONSUMER_H_ONLY: "H", CONSUMER_M_ONLY: "M"}
+
+# Measured crossover: below this many rows, converting the payload tuples with
+# np.asarray costs more than the plain loop saves (at 1000 rows they are about even).
+# Past it the numba loop, when installed, edges out the NumPy reductions.
+VECTORIZE_MIN_ROWS = 2000
+
 # --- Session State Management ---
+# Expenses are stored column-wise: one parallel list per field
 if 'expenses' not in st.session_state:
-    st.session_state.expenses = []
+    st.session_state.expenses = {col: [] for col in COLUMNS}
+    # Amounts bucketed by category and consumer, kept in step with the expenses.
+    # Buckets hold the amounts pre-formatted for the CSV plus a running float total;
+    # a category only gets buckets once it has an expense.
+    st.session_state.grouped = {}
 
 
 # --- Helper Functions ---
 def add_expense(category, amount, payer, consumer):
-    """Adds a new expense to the session state."""
-    st.session_state.expenses.append({
-        "Category": category,
-        "Amount": float(amount),
-        "Payer": payer,
-        "Consumer": consumer
+    """Adds a new expense to the session state (payer and consumer as integer codes)."""
+    amount = float(amount)
+    expenses = st.session_state.expenses
+    expenses["Category"].append(category)
+    expenses["Amount"].append(amount)
+    expenses["Payer"].append(payer)
+    expenses["Consumer"].append(consumer)
+
+    # Copy-on-write: the buckets are never mutated in place, so a CSV callable created
+    # on an earlier rerun still sees the buckets it was rendered with
+    grouped = st.session_state.grouped
+    old = grouped.get(category) or {"H": [], "M": [], "Split": [], "Total": 0.0}
+    key = CONSUMER_BUCKETS.get(consumer, "Split")
+    buckets = {**old, key: old[key] + [str(amount)], "Total": old["Total"] + amount}
+    st.session_state.grouped = {**grouped, category: buckets}
+
+
+def group_expenses(data):
+    """Rebuilds the category/consumer buckets from scratch for the given columns."""
+    grouped = {}
+
+    for cat, amt, cons in zip(data["Category"], data["Amount"], data["Consumer"]):
+        if cat not in grouped:
+            grouped[cat] = {"H": [], "M": [], "Split": [], "Total": 0.0}
+
+        amt = float(amt)
+        buckets = grouped[cat]
+        buckets[CONSUMER_BUCKETS.get(cons, "Split")].append(str(amt))
+        buckets["Total"] += amt
+
+    return grouped
+
+
+def expense_payload(data):
+    """Snapshots the expense columns as a hashable tuple for the cached helpers below."""
+    return (
+        tuple(data["Category"]),
+        tuple(map(float, data["Amount"])),
+        tuple(data["Payer"]),
+        tuple(data["Consumer"]),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def load_settle_kernel():
+    """Compiles the settlement loop with numba once per process, or returns None without numba."""
+    try:
+        from numba import njit
+    except ImportError:
+        return None
+
+    # No cache=True: loading numba's on-disk cache re-imports (and so re-runs) this script
+    @njit
+    def settle(amt, payer_h, cons_code):
+        total_paid_h = 0.0
+        total_paid_m = 0.0
+        cost_h = 0.0
+        cost_m = 0.0
+        for i in range(amt.shape[0]):
+            a = amt[i]
+            if payer_h[i]:
+                total_paid_h += a
+            else:
+                total_paid_m += a
+
+            c = cons_code[i]
+            if c == CONSUMER_SPLIT:
+                cost_h += a / 2
+                cost_m += a / 2
+            elif c == CONSUMER_H_ONLY:
+                cost_h += a
+            else:  # M only
+                cost_m += a
+        return total_paid_h, total_paid_m, cost_h, cost_m, total_paid_h - cost_h
+
+    # Warm the JIT with a one-row call so the first large settlement skips compilation
+    settle(np.zeros(1), np.zeros(1, dtype=np.int8), np.zeros(1, dtype=np.int8))
+    return settle
+
+
+# Load (and warm) the kernel at startup; later reruns hit the resource cache
+load_settle_kernel()
+
+
+def expense_frame(data):
+    """Builds the editor DataFrame, with categorical dtypes matching the selectbox options.
+
+    Any value outside the option lists becomes a blank cell.
+    """
+    return pd.DataFrame({
+        "Category": pd.Categorical(data["Category"], categories=CATEGORIES),
+        "Amount": np.asarray(data["Amount"], dtype=np.float64),
+        "Payer": pd.Categorical.from_codes(data["Payer"], categories=PAYERS),
+        "Consumer": pd.Categorical.from_codes(data["Consumer"], categories=CONSUMERS),
     })
 
 
-def calculate_settlement(data):
-    """Calculates totals and who owes whom based on the provided list of dicts."""
+def expense_columns(frame):
+    """Converts an editor DataFrame back to session state columns, mapping labels to codes."""
+    return {
+        "Category": frame["Category"].tolist(),
+        "Amount": frame["Amount"].tolist(),
+        "Payer": pd.Categorical(frame["Payer"], categories=PAYERS).codes.tolist(),
+        "Consumer": pd.Categorical(frame["Consumer"], categories=CONSUMERS).codes.tolist(),
+    }
+
+
+def frame_fingerprint(frame):
+    """Cheap content fingerprint of an editor DataFrame, used to spot untouched tables.
+
+    Hashes the per-row hashes in order, so reordered rows count as an edit.
+    """
+    return hash(pd.util.hash_pandas_object(frame, index=False).values.tobytes())
+
+
+def calculate_settlement(payload):
+    """Calculates totals and who owes whom based on the expense payload."""
+    _, amounts, payers, consumers = payload
+    if len(amounts) >= VECTORIZE_MIN_ROWS:
+        amt = np.asarray(amounts, dtype=np.float64)
+        paid_h = np.asarray(payers) == PAYER_H
+        cons = np.asarray(consumers, dtype=np.int8)
+        split = cons == CONSUMER_SPLIT
+        h_only = cons == CONSUMER_H_ONLY
+
+        settle = load_settle_kernel()
+        if settle is not None:
+            return settle(amt, paid_h.astype(np.int8), cons)
+
+        # Branchless: select each row's amount into every figure with np.where instead of
+        # gathering boolean-indexed copies. Unselected rows contribute a literal 0.0 (not
+        # 0 * amount), so a blank (NaN) amount only reaches the figures its own row feeds.
+        m_only = ~(split | h_only)
+        total_paid_h = float(np.where(paid_h, amt, 0.0).sum())
+        total_paid_m = float(np.where(paid_h, 0.0, amt).sum())
+        split_half = 0.5 * np.where(split, amt, 0.0).sum()
+        cost_h = float(np.where(h_only, amt, 0.0).sum() + split_half)
+        cost_m = float(np.where(m_only, amt, 0.0).sum() + split_half)
+        return total_paid_h, total_paid_m, cost_h, cost_m, total_paid_h - cost_h
+
     total_paid_h = 0.0
     total_paid_m = 0.0
     cost_h = 0.0
     cost_m = 0.0
 
-    for exp in data:
-        amt = float(exp['Amount'])
-
+    for amt, payer, consumer in zip(amounts, payers, consumers):
         # Who Paid (Cash Flow)
-        if exp['Payer'] == 'H':
+        if payer == PAYER_H:
             total_paid_h += amt
         else:
             total_paid_m += amt
 
         # Who Used (Consumption)
-        if exp['Consumer'] == 'Split':
+        if consumer == CONSUMER_SPLIT:
             cost_h += amt / 2
             cost_m += amt / 2
-        elif exp['Consumer'] == 'H only':
+        elif consumer == CONSUMER_H_ONLY:
             cost_h += amt
         else:  # M only
             cost_m += amt
@@ -57,55 +208,78 @@ def calculate_settlement(data):
     return total_paid_h, total_paid_m, cost_h, cost_m, balance_h
 
 
-def generate_csv(data):
-    """Generates the CSV string with Google Sheets formulas."""
-    grouped = {cat: {"H": [], "M": [], "Split": []} for cat in CATEGORIES}
+def generate_csv(grouped, settlement):
+    """Generates the CSV string with Google Sheets formulas from the buckets and settlement."""
+    # Header + one row per category + blank, SUMMARY and two summary rows + the
+    # trailing empty entry that gives the joined output its final newline
+    lines = [None] * (len(grouped) + 6)
+    lines[0] = "Category,H Cost (Formula),M Cost (Formula),Total Category Cost"
 
-    for exp in data:
-        cat = exp['Category']
-        amt = exp['Amount']
-        cons = exp['Consumer']
+    # Only categories with expenses have buckets. The editor frame only admits CATEGORIES,
+    # so the one key outside it is a blank category from a half-filled row, listed last.
+    cats = sorted(grouped, key=lambda c: CATEGORY_ORDER.get(c, len(CATEGORIES)))
+    for i, cat in enumerate(cats, start=1):
+        buckets = grouped[cat]
+        h_vals = buckets["H"]
+        m_vals = buckets["M"]
+        s_vals = buckets["Split"]
 
-        # Safety check if category was typed manually and not in list
-        if cat not in grouped:
-            grouped[cat] = {"H": [], "M": [], "Split": []}
+        p_h = "+".join(h_vals) if h_vals else "0"
+        p_m = "+".join(m_vals) if m_vals else "0"
+        s_all = "+".join(s_vals) if s_vals else "0"
 
-        if cons == 'H only':
-            grouped[cat]["H"].append(amt)
-        elif cons == 'M only':
-            grouped[cat]["M"].append(amt)
-        else:
-            grouped[cat]["Split"].append(amt)
+        h_formula = f"=(({p_h}) + ({s_all})/2)"
+        m_formula = f"=(({p_m}) + ({s_all})/2)"
+        total_val = buckets["Total"]
 
-    output = io.StringIO()
-    output.write("Category,H Cost (Formula),M Cost (Formula),Total Category Cost\n")
+        lines[i] = f"{cat},{h_formula},{m_formula},{total_val}"
 
-    for cat in grouped:
-        h_vals = grouped[cat]["H"]
-        m_vals = grouped[cat]["M"]
-        s_vals = grouped[cat]["Split"]
+    # Summary Section
+    tp_h, tp_m, c_h, c_m, bal = settlement
+    settlement_txt = f"M owes H: ${abs(bal):.2f}" if bal > 0 else f"H owes M: ${abs(bal):.2f}"
+    if abs(bal) < 0.01: settlement_txt = "All Square"
 
-        if h_vals or m_vals or s_vals:
-            p_h = "+".join(map(str, h_vals)) if h_vals else "0"
-            p_m = "+".join(map(str, m_vals)) if m_vals else "0"
-            s_all = "+".join(map(str, s_vals)) if s_vals else "0"
+    lines[-5] = ""
+    lines[-4] = "SUMMARY,,,"
+    lines[-3] = f"Total Paid By H,${tp_h:.2f},Total Paid By M,${tp_m:.2f}"
+    lines[-2] = f"Who Owes Whom?,{settlement_txt},,"
+    lines[-1] = ""
 
-            h_formula = f"=(({p_h}) + ({s_all})/2)"
-            m_formula = f"=(({p_m}) + ({s_all})/2)"
-            total_val = sum(h_vals) + sum(m_vals) + sum(s_vals)
+    return "\n".join(lines)
 
-            output.write(f"{cat},{h_formula},{m_formula},{total_val}\n")
 
-    # Summary Section
-    tp_h, tp_m, c_h, c_m, bal = calculate_settlement(data)
-    settlement_txt = f"M owes H: ${abs(bal):.2f}" if bal > 0 else f"H owes M: ${abs(bal):.2f}"
-    if abs(bal) < 0.01: settlement_txt = "All Square"
+@st.fragment
+def render_settlement(payload, grouped, settlement):
+    """Renders the Settlement panel as a fragment so its own widgets only rerun this panel."""
+    tp_h, tp_m, cost_h, cost_m, balance = settlement
+
+    st.subheader("Settlement")
+
+    # Styled Result Card
+    if abs(balance) < 0.01:
+        st.info("All Square!")
+    elif balance > 0:
+        st.success(f"**M owes H: ${abs(balance):.2f}**")
+    else:
+        st.warning(f"**H owes M: ${abs(balance):.2f}**")
+
+    st.metric("Total Paid by H", f"${tp_h:.2f}")
+    st.metric("Total Paid by M", f"${tp_m:.2f}")
 
-    output.write("\nSUMMARY,,,\n")
-    output.write(f"Total Paid By H,${tp_h:.2f},Total Paid By M,${tp_m:.2f}\n")
-    output.write(f"Who Owes Whom?,{settlement_txt},,\n")
+    st.markdown("---")
 
-    return output.getvalue()
+    # CSV Download (payload[0] is the Category column, so empty means no expenses).
+    # The CSV is only generated when the button is actually clicked; `grouped` is safe to
+    # capture because add_expense and the editor sync replace it rather than mutate it.
+    if payload[0]:
+        st.download_button(
+            label="📥 Download CSV",
+            data=lambda: generate_csv(grouped, settlement),
+            file_name="monthly_expenses.csv",
+            mime="text/csv",
+            type="primary",
+            use_container_width=True
+        )
 
 
 # --- UI Layout ---
@@ -120,9 +294,11 @@ with st.expander("Add New Expense", expanded=True):
         with c2:
             amt_input = st.number_input("Amount ($)", min_value=0.01, step=0.01, format="%.2f")
         with c3:
-            payer_input = st.selectbox("Who Paid?", ["H", "M"])
+            payer_input = st.selectbox("Who Paid?", range(len(PAYERS)), format_func=PAYERS.__getitem__)
         with c4:
-            consumer_input = st.selectbox("Who Used It?", ["Split", "H only", "M only"])
+            consumer_input = st.selectbox(
+                "Who Used It?", range(len(CONSUMERS)), format_func=CONSUMERS.__getitem__
+            )
 
         submitted = st.form_submit_button("Add Expense", type="primary")
 
@@ -139,12 +315,16 @@ with col_left:
     st.subheader("Expense History (Edit Mode)")
     st.caption("Double-click any cell to edit. Select rows and press 'Delete' to remove.")
 
-    # Convert session state list to DataFrame for the editor
-    df = pd.DataFrame(st.session_state.expenses)
-
-    # If df is empty, we need valid columns for the editor to show correctly
-    if df.empty:
-        df = pd.DataFrame(columns=["Category", "Amount", "Payer", "Consumer"])
+    # The session state columns map straight onto the DataFrame for the editor.
+    # Only rebuild it (and the settlement) when the stored expenses changed since the
+    # last rerun; comparing the payload itself is exact, unlike comparing hashes.
+    payload = expense_payload(st.session_state.expenses)
+    if st.session_state.get('_df_cache_payload') != payload:
+        st.session_state._df_cache = expense_frame(st.session_state.expenses)
+        st.session_state._df_cache_payload = payload
+        st.session_state._edit_fp = frame_fingerprint(st.session_state._df_cache)
+        st.session_state._settlement = calculate_settlement(payload)
+    df = st.session_state._df_cache
 
     # --- THE DATA EDITOR ---
     edited_df = st.data_editor(
@@ -169,12 +349,12 @@ with col_left:
             ),
             "Payer": st.column_config.SelectboxColumn(
                 "Who Paid?",
-                options=["H", "M"],
+                options=PAYERS,
                 required=True,
             ),
             "Consumer": st.column_config.SelectboxColumn(
                 "Who Used?",
-                options=["Split", "H only", "M only"],
+                options=CONSUMERS,
                 required=True,
             )
         },
@@ -182,37 +362,20 @@ with col_left:
     )
 
     # Sync changes back to session state so they persist
-    # We convert the edited dataframe back to a list of dicts
-    current_data = edited_df.to_dict('records')
-    st.session_state.expenses = current_data
+    edit_fp = frame_fingerprint(edited_df)
+    if edit_fp == st.session_state._edit_fp:
+        # Table untouched: the stored columns (and payload) are already current
+        current_data = st.session_state.expenses
+    else:
+        st.session_state._edit_fp = edit_fp
+        # We convert the edited dataframe back to one list per column
+        current_data = expense_columns(edited_df)
+        # Rows were edited or deleted in the table, so regroup from scratch
+        st.session_state.grouped = group_expenses(current_data)
+        st.session_state.expenses = current_data
+        payload = expense_payload(current_data)
+        st.session_state._settlement = calculate_settlement(payload)
 
 with col_right:
     # Use the current_data (from the editor) for calculations immediately
-    tp_h, tp_m, cost_h, cost_m, balance = calculate_settlement(current_data)
-
-    st.subheader("Settlement")
-
-    # Styled Result Card
-    if abs(balance) < 0.01:
-        st.info("All Square!")
-    elif balance > 0:
-        st.success(f"**M owes H: ${abs(balance):.2f}**")
-    else:
-        st.warning(f"**H owes M: ${abs(balance):.2f}**")
-
-    st.metric("Total Paid by H", f"${tp_h:.2f}")
-    st.metric("Total Paid by M", f"${tp_m:.2f}")
-
-    st.markdown("---")
-
-    # CSV Download
-    if current_data:
-        csv_data = generate_csv(current_data)
-        st.download_button(
-            label="📥 Download CSV",
-            data=csv_data,
-            file_name="monthly_expenses.csv",
-            mime="text/csv",
-            type="primary",
-            use_container_width=True
-        )
\ No newline at end of file
+    render_settlement(payload, st.session_state.grouped, st.session_state._settlement)